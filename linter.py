@@ -10,32 +10,133 @@
 
 """This module exports the Gometalinter plugin class."""
 
+import atexit
+import errno
+import hashlib
 import os
+import re
 import shlex
-import tempfile
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import sublime_plugin
 
 from SublimeLinter.lint import Linter, highlight, util
 from SublimeLinter.lint.persist import settings
 
+# os.scandir is only available from Python 3.5
+scandir = getattr(os, 'scandir', None)
+
+CACHE_SIZE = 2000
+SCRATCH_DIR = '.golangci-lint-scratch'
+LIVE_LINT_DELAY = 0.3
+LIVE_LINT_MAX_FILES = 40
+# golangci-lint exits 1 when it found issues anywhere, anything else but 0 means it failed to lint
+ISSUES_EXIT_CODES = (0, 1)
+CONFIG_FILES = ('go.mod', 'go.sum', '.golangci.yml', '.golangci.yaml', '.golangci.toml', '.golangci.json')
+LINK_WORKERS = 8
+# up to this many stale links are made serially; handing so few to the pool costs more than it saves
+PARALLEL_LINKS = 8
+# issues from these linters are shown as errors, everything else as a warning
+ERROR_LINTERS = frozenset({'typecheck'})
+FICLONE = 0x40049409  # linux/fs.h, copy-on-write clone on btrfs and xfs
+
+# os.link errors meaning the filesystem can't hard link here, rather than that something is wrong
+LINK_UNSUPPORTED = frozenset(getattr(errno, name) for name in ('EXDEV', 'EPERM', 'ENOTSUP', 'EOPNOTSUPP', 'EMLINK')
+                             if hasattr(errno, name))
+
+# (filename, cmd, env) -> ((sibling, config, binary) stat signature, buffer digest, filtered output), oldest
+# first. Only kept for the session, and cleared whenever a Go file is saved.
+_LINT_CACHE = OrderedDict()
+_LINT_CACHE_LOCK = threading.Lock()
+
+# source dir -> (scratch dir mtime after our last sync,
+#                {name: (mtime, inode) of the linked source, or None for the buffer copy})
+_SCRATCH = {}
+_SCRATCH_LOCKS = {}
+# guards _SCRATCH, _SCRATCH_LOCKS, _BUFFER_FDS and _DISK_DIGESTS; only held for the dict operations
+_SCRATCH_LOCK = threading.Lock()
+_LINK_POOL = ThreadPoolExecutor(max_workers=LINK_WORKERS)
+
+# scratch buffer copy -> descriptor kept open for rewriting it
+_BUFFER_FDS = {}
+
+# filename -> (mtime, size, digest) of its saved contents
+_DISK_DIGESTS = {}
+
+# filename -> golangci-lint process still running for it
+_PENDING = {}
+_PENDING_LOCK = threading.Lock()
+
+# filename -> sequence number of the latest live lint request
+_DEBOUNCE = {}
+
+# filename -> bytes pattern matching the output lines reported for it
+_PREFIX_RES = {}
+
 
 class GolangCILint(Linter):
     """Provides an interface to golangci-lint."""
 
     syntax = ('go', 'gosublime-go', 'gotools', 'anacondago-go')
-    cmd = 'golangci-lint run --fast --enable typecheck'
-    regex = r'(?:[^:]+):(?P<line>\d+):(?P<col>\d+)?:\s*(?P<message>.*)'
+    cmd = 'golangci-lint run --fast --enable typecheck --out-format line-number --print-issued-lines=false'
+    regex = (r'^(?:[A-Za-z]:)?[^:]+:(?P<line>\d+):(?P<col>\d+)?:\s*'
+             r'(?P<message>.*?(?:\((?:(?P<error>' + '|'.join(sorted(map(re.escape, ERROR_LINTERS))) + r')|'
+             r'(?P<warning>[\w-]+))\))?)$')
+    re_flags = re.ASCII
     error_stream = util.STREAM_BOTH
     default_type = highlight.ERROR
 
     def run(self, cmd, code):
-        filename = os.path.basename(self.filename)
-        if settings.get('lint_mode') == 'background':
-            out = self._live_lint(cmd, code)
+        code_bytes = code.encode('utf8') if isinstance(code, str) else code
+        code_digest = digest(code_bytes)
+        dir, env = self._dir_env()
+        key = (self.filename, tuple(cmd), tuple(sorted(env.items())) if env else ())
+        live = settings.get('lint_mode') == 'background'
+        try:
+            files = go_files(os.path.dirname(self.filename), limit=LIVE_LINT_MAX_FILES if live else None)
+        except OSError as e:
+            # linting without the siblings would only report spurious undefined names
+            debug('failed to list {}: {}', os.path.dirname(self.filename), e)
+            return ''
+        if files is None:
+            debug('more than {} files, live linting skipped', LIVE_LINT_MAX_FILES)
+            return ''
+        signature = (stat_signature(files), config_signature(dir), binary_signature(cmd[0], env))
+        # only keystrokes are served from the cache; a save or load always re-runs, because imported
+        # packages can have changed in ways the signature doesn't cover
+        cached = cache_lookup(key, signature, code_digest) if live else None
+        if cached is not None:
+            return cached
+
+        if live and not debounce(self.filename):
+            # another edit arrived within LIVE_LINT_DELAY, only the latest one is linted
+            return cache_latest(key)
+
+        cancel(self.filename)
+        if live:
+            result = self._live_lint(cmd, code_bytes, code_digest, files, dir, env)
         else:
-            out = self._in_place_lint(cmd)
-        lines = [line for line in out.splitlines()
-                 if line.startswith(filename + ':')]
-        return '\n'.join(lines)
+            result = self._in_place_lint(cmd, dir, env)
+        if result is None:
+            # superseded by a newer run; keep showing the last result until that one completes
+            return cache_latest(key)
+        out, ok = result
+        if ok:
+            cache_store(key, signature, code_digest, out)
+        return out
 
     def _dir_env(self):
         settings = self.get_view_settings()
@@ -43,46 +144,433 @@ class GolangCILint(Linter):
         env = self.get_environment(settings)
         return dir, env
 
-    def _live_lint(self, cmd, code):
-        dir, env = self._dir_env()
+    def _live_lint(self, cmd, code_bytes, code_digest, files, dir, env):
         if not dir:
-            print('golangci-lint: skipped linting of unsaved file')
-            return
-        filename = os.path.basename(self.filename)
-        print('golangci-lint: live linting {} in {}: {}'.format(filename, dir, ' '.join(map(shlex.quote, cmd))))
-        files = [f for f in os.listdir(dir) if f.endswith('.go')]
-        if len(files) > 40:
-            print("golangci-lint: too many files ({}), live linting skipped".format(len(files)))
-            return ''
-        return tmpdir(cmd, dir, files, self.filename, code, env=env)
+            debug('skipped linting of unsaved file')
+            return '', True
+        if not self.view.is_dirty() or code_digest == disk_digest(self.filename, files):
+            # the buffer matches what is on disk, so there is nothing to copy
+            return self._in_place_lint(cmd, dir, env)
+        debug('live linting {} in {}: {}', lambda: os.path.basename(self.filename), dir, lambda: quote(cmd))
+        return tmpdir(cmd, dir, files, self.filename, code_bytes, env=env)
 
-    def _in_place_lint(self, cmd):
-        dir, env = self._dir_env()
+    def _in_place_lint(self, cmd, dir, env):
         if not dir:
-            print('golangci-lint: skipped linting of unsaved file')
-            return
-        filename = os.path.basename(self.filename)
-        print('golangci-lint: in-place linting {}: {}'.format(filename, ' '.join(map(shlex.quote, cmd))))
-        out = util.communicate(cmd, output_stream=util.STREAM_BOTH, env=env, cwd=dir)
-        return out or ''
+            debug('skipped linting of unsaved file')
+            return '', True
+        debug('in-place linting {}: {}', lambda: os.path.basename(self.filename), lambda: quote(cmd))
+        return communicate(cmd, self.filename, env=env, cwd=dir)
+
+
+def debug(message, *args):
+    """Print message formatted with args to the console if SublimeLinter's debug setting is on.
+
+    Callable args are only called when the message is printed, so costly ones can be deferred.
+    """
+    if settings.get('debug'):
+        print('golangci-lint: ' + message.format(*[arg() if callable(arg) else arg for arg in args]))
+
+
+def quote(cmd):
+    """Return cmd as a shell-quoted string."""
+    return ' '.join(map(shlex.quote, cmd))
+
+
+def communicate(cmd, filename, env=None, cwd=None):
+    """Run an external executable and return (its output lines for filename, whether it is fit to cache).
+
+    Output is read as it is produced and lines for other files are dropped immediately, rather than
+    buffering the whole report first. A run that failed (exited other than 0 or 1) without reporting
+    anything for filename is not fit to cache. Returns None if the run was cancelled by a newer one.
+    """
+    startupinfo = None
+    if os.name == 'nt':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                env=env, cwd=cwd, startupinfo=startupinfo)
+    except OSError as e:
+        print('golangci-lint: failed to run {}: {}'.format(cmd[0], e))
+        return '', False
+    with _PENDING_LOCK:
+        _PENDING[filename] = proc
+
+    # match and collect raw bytes, decoding only what is kept, once
+    pattern = prefix_re(filename)
+    out = bytearray()
+    with proc.stdout:
+        for line in proc.stdout:
+            if line.isspace():
+                continue
+            match = pattern.match(line)
+            if match:
+                out += match.group(0)
+                out += b'\n'
+    proc.wait()
+
+    with _PENDING_LOCK:
+        if _PENDING.get(filename) is not proc:
+            return None
+        del _PENDING[filename]
+    return out.decode('utf8', 'replace').rstrip('\n'), bool(out) or proc.returncode in ISSUES_EXIT_CODES
+
+
+def debounce(filename):
+    """Wait LIVE_LINT_DELAY and return whether this is still the latest request to lint filename."""
+    with _PENDING_LOCK:
+        generation = _DEBOUNCE[filename] = _DEBOUNCE.get(filename, 0) + 1
+    time.sleep(LIVE_LINT_DELAY)
+    with _PENDING_LOCK:
+        return _DEBOUNCE[filename] == generation
+
+
+def cancel(filename):
+    """Terminate the run in progress for filename, if any."""
+    with _PENDING_LOCK:
+        proc = _PENDING.pop(filename, None)
+    if proc is not None and proc.poll() is None:
+        proc.terminate()
 
 
 def tmpdir(cmd, dir, files, filename, code, env=None):
-    """Run an external executable using a temp dir filled with files and return its output."""
-    with tempfile.TemporaryDirectory(dir=dir, prefix=".golangci-lint-") as tmpdir:
-        for f in files:
-            target = os.path.join(tmpdir, f)
-            f = os.path.join(dir, f)
-
-            if os.path.basename(target) == os.path.basename(filename):
-                # source file hasn't been saved since change, so update it from our live buffer
-                with open(target, 'wb') as f:
-                    if isinstance(code, str):
-                        code = code.encode('utf8')
-
-                    f.write(code)
-            else:
-                os.link(f, target)
-
-        out = util.communicate(cmd, output_stream=util.STREAM_BOTH, env=env, cwd=tmpdir)
-    return out or ''
+    """Run an external executable in the scratch copy of dir and return its output.
+
+    golangci-lint has no equivalent of `go build -overlay`, so the unsaved buffer can't be substituted
+    in place; the package is mirrored into a scratch dir with the buffer standing in for filename.
+    """
+    scratch = os.path.join(dir, SCRATCH_DIR)
+    with scratch_lock(scratch):
+        sync_scratch(dir, scratch, files, os.path.basename(filename), code)
+        return communicate(cmd, filename, env=env, cwd=scratch)
+
+
+@contextmanager
+def scratch_lock(scratch, create=True):
+    """Hold the scratch dir exclusively against other threads and other Sublime Text instances.
+
+    Unless create is set, nothing is created: a missing scratch dir or lock file is not locked on disk.
+    """
+    with _SCRATCH_LOCK:
+        lock = _SCRATCH_LOCKS.setdefault(scratch, threading.Lock())
+    with lock:
+        if create:
+            os.makedirs(scratch, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        try:
+            f = open(os.path.join(scratch, '.lock'), 'a' if create else 'r')
+        except OSError:
+            if create:
+                raise
+            yield
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def sync_scratch(dir, scratch, files, active, code):
+    """Bring the links in scratch up to date with files in dir, and replace active with the buffer.
+
+    Only links whose source changed since the previous sync are replaced. Must be called with the
+    scratch lock held.
+    """
+    with _SCRATCH_LOCK:
+        stamp, linked = _SCRATCH.get(dir, (None, None))
+    if linked is None or os.stat(scratch).st_mtime_ns != stamp:
+        # first use, or another instance has been here since; start from an empty dir
+        close_buffers(scratch)
+        for name in os.listdir(scratch):
+            if name.endswith('.go'):
+                os.unlink(os.path.join(scratch, name))
+        linked = {}
+
+    for name in set(linked) - set(name for name, st in files):
+        close_buffer(os.path.join(scratch, name))
+        os.unlink(os.path.join(scratch, name))
+        del linked[name]
+
+    stale = []
+    for name, st in files:
+        if name == active:
+            # never write the buffer through a link, that would clobber the source file
+            if linked.get(name) is not None:
+                os.unlink(os.path.join(scratch, name))
+            linked[name] = None
+            continue
+
+        # a new inode with the same mtime means the file was replaced by rename
+        version = (st.st_mtime_ns, st.st_ino)
+        if linked.get(name, ()) != version:
+            stale.append((name, version))
+
+    jobs = [(os.path.join(dir, name), os.path.join(scratch, name), name in linked) for name, version in stale]
+    for src, target, replace in jobs:
+        # a replaced target may be a former buffer copy; close it here rather than on a pool thread
+        if replace:
+            close_buffer(target)
+    if len(jobs) > PARALLEL_LINKS:
+        # links are independent, so overlap the syscalls when there are enough of them to pay for it
+        list(_LINK_POOL.map(lambda job: relink(*job), jobs))
+    else:
+        for job in jobs:
+            relink(*job)
+    linked.update(stale)
+
+    # source file hasn't been saved since change, so update it from our live buffer
+    write_buffer(os.path.join(scratch, active), code)
+    stamp = os.stat(scratch).st_mtime_ns
+    with _SCRATCH_LOCK:
+        _SCRATCH[dir] = (stamp, linked)
+
+
+def relink(src, target, replace):
+    """Clone src to target, first removing an existing target if replace is set."""
+    if replace:
+        os.unlink(target)
+    clone(src, target)
+
+
+def clone(src, target):
+    """Hard link src to target, falling back to a reflink and then a copy where links are unsupported."""
+    try:
+        os.link(src, target)
+        return
+    except OSError as e:
+        if e.errno not in LINK_UNSUPPORTED:
+            raise
+    # 'xb' never truncates an existing target, which may share its inode with a source file
+    with open(src, 'rb') as source, open(target, 'xb') as dest:
+        if fcntl is not None and sys.platform.startswith('linux'):
+            try:
+                fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+        shutil.copyfileobj(source, dest)
+
+
+def write_buffer(target, code):
+    """Replace the contents of target with code.
+
+    Where os.pwrite is available the file is kept open between calls, so each keystroke costs a
+    write and a truncate rather than an open/write/close.
+    """
+    if not hasattr(os, 'pwrite'):
+        with open(target, 'wb') as f:
+            f.write(code)
+        return
+
+    with _SCRATCH_LOCK:
+        fd = _BUFFER_FDS.get(target)
+    if fd is None:
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        with _SCRATCH_LOCK:
+            _BUFFER_FDS[target] = fd
+    view = memoryview(code)
+    written = 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], written)
+    os.ftruncate(fd, written)
+
+
+def close_buffer(target):
+    """Close the descriptor write_buffer() holds open for target, if any."""
+    with _SCRATCH_LOCK:
+        fd = _BUFFER_FDS.pop(target, None)
+    if fd is not None:
+        os.close(fd)
+
+
+def close_buffers(scratch):
+    """Close every descriptor write_buffer() holds open in scratch."""
+    with _SCRATCH_LOCK:
+        fds = [_BUFFER_FDS.pop(target) for target in list(_BUFFER_FDS) if os.path.dirname(target) == scratch]
+    for fd in fds:
+        os.close(fd)
+
+
+def remove_scratch():
+    """Delete every scratch dir created by this instance."""
+    with _SCRATCH_LOCK:
+        dirs = list(_SCRATCH)
+        _SCRATCH.clear()
+    for dir in dirs:
+        scratch = os.path.join(dir, SCRATCH_DIR)
+        close_buffers(scratch)
+        if not os.path.isdir(scratch):
+            continue
+        with scratch_lock(scratch, create=False):
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+atexit.register(remove_scratch)
+
+
+def plugin_unloaded():
+    """Clean up scratch dirs."""
+    remove_scratch()
+    _LINK_POOL.shutdown(wait=False)
+
+
+class GolangCILintCacheListener(sublime_plugin.EventListener):
+    """Drops cached lint results whenever a Go file is saved."""
+
+    def on_post_save_async(self, view):
+        """Forget every cached result, since the saved file may be imported by any of them."""
+        filename = view.file_name()
+        if filename and filename.endswith('.go'):
+            with _LINT_CACHE_LOCK:
+                _LINT_CACHE.clear()
+
+
+def prefix_re(filename):
+    """Return a compiled pattern matching an output line for filename, less its line ending.
+
+    golangci-lint usually reports paths relative to the package dir, but may print the absolute path
+    (with a drive letter on Windows) of the file or of its scratch copy, so both forms are matched.
+    """
+    pattern = _PREFIX_RES.get(filename)
+    if pattern is None:
+        dir, name = os.path.split(filename)
+        pattern = re.compile(br'(?:' + re.escape(dir.encode('utf8')) + br'[\\/]' +
+                             br'(?:' + re.escape(SCRATCH_DIR.encode('utf8')) + br'[\\/])?)?' +
+                             re.escape(name.encode('utf8')) + br':[^\r\n]*')
+        _PREFIX_RES[filename] = pattern
+    return pattern
+
+
+def stat_signature(files):
+    """Return a cheap (name, mtime, size) fingerprint of files as returned by go_files()."""
+    return tuple(sorted((name, st.st_mtime_ns, st.st_size) for name, st in files))
+
+
+def config_signature(dir):
+    """Return a (path, mtime, size) fingerprint of the module and linter config that applies to dir.
+
+    Directories are searched upwards until the one holding go.mod.
+    """
+    signature = []
+    while dir:
+        for name in CONFIG_FILES:
+            path = os.path.join(dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            signature.append((path, st.st_mtime_ns, st.st_size))
+        parent = os.path.dirname(dir)
+        if parent == dir or any(path == os.path.join(dir, 'go.mod') for path, _, _ in signature):
+            break
+        dir = parent
+    return tuple(signature)
+
+
+def binary_signature(executable, env=None):
+    """Return a (path, mtime, size) fingerprint of the executable that will be run, or None if not found."""
+    path = shutil.which(executable, path=(env or os.environ).get('PATH'))
+    try:
+        st = os.stat(path or executable)
+    except OSError:
+        return None
+    return (path or executable, st.st_mtime_ns, st.st_size)
+
+
+def go_files(dir, limit=None):
+    """Return (name, stat) for every regular .go file in dir, or None as soon as there are more than limit."""
+    files = []
+    if scandir is not None:
+        entries = scandir(dir)
+        try:
+            for entry in entries:
+                if not entry.name.endswith('.go'):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    # removed or renamed since the directory was read
+                    continue
+                files.append((entry.name, st))
+                if limit is not None and len(files) > limit:
+                    return None
+        finally:
+            # the iterator only has close() from 3.6; before that it is closed once garbage collected
+            if hasattr(entries, 'close'):
+                entries.close()
+        return files
+
+    for name in os.listdir(dir):
+        if not name.endswith('.go'):
+            continue
+        try:
+            st = os.stat(os.path.join(dir, name))
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files.append((name, st))
+            if limit is not None and len(files) > limit:
+                return None
+    return files
+
+
+def digest(code):
+    """Return a content hash of an encoded buffer."""
+    return hashlib.sha256(code).digest()
+
+
+def disk_digest(filename, files):
+    """Return the content hash of the saved filename, rehashing only if its stat in files changed."""
+    name = os.path.basename(filename)
+    for other, st in files:
+        if other == name:
+            break
+    else:
+        return None
+    with _SCRATCH_LOCK:
+        entry = _DISK_DIGESTS.get(filename)
+    if entry is None or entry[:2] != (st.st_mtime_ns, st.st_size):
+        try:
+            with open(filename, 'rb') as f:
+                entry = (st.st_mtime_ns, st.st_size, digest(f.read()))
+        except OSError:
+            return None
+        with _SCRATCH_LOCK:
+            _DISK_DIGESTS[filename] = entry
+    return entry[2]
+
+
+def cache_lookup(key, signature, code_digest):
+    """Return cached output if neither the siblings nor the buffer changed, otherwise None."""
+    with _LINT_CACHE_LOCK:
+        entry = _LINT_CACHE.get(key)
+    if entry is None or entry[0] != signature or entry[1] != code_digest:
+        return None
+    with _LINT_CACHE_LOCK:
+        if key in _LINT_CACHE:
+            _LINT_CACHE.move_to_end(key)
+    return entry[2]
+
+
+def cache_latest(key):
+    """Return the most recent output stored for key, whatever it was computed from."""
+    with _LINT_CACHE_LOCK:
+        entry = _LINT_CACHE.get(key)
+    return entry[2] if entry is not None else ''
+
+
+def cache_store(key, signature, code_digest, out):
+    """Remember the output for a buffer, evicting the oldest entries beyond CACHE_SIZE."""
+    entry = (signature, code_digest, out)
+    with _LINT_CACHE_LOCK:
+        _LINT_CACHE[key] = entry
+        _LINT_CACHE.move_to_end(key)
+        while len(_LINT_CACHE) > CACHE_SIZE:
+            _LINT_CACHE.popitem(last=False)